@@ -583,6 +583,9 @@ def _add_text_generate_args(parser):
                        help='Top k sampling.')
     group.add_argument("--max-new-tokens", type=int, default=None,
                        help='Maximum number of new tokens to generate.')
+    group.add_argument("--compile-transformer-layers", action='store_true',
+                       help='Compile the transformer layers with torch.compile '
+                       'for generation.')
 
     return parser
 
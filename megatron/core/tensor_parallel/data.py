@@ -101,8 +101,14 @@ def broadcast_data(keys, data, datatype):
         # Check that all keys have the same data type.
         _check_data_types(keys, data, datatype)
         # Flatten the data associated with the keys
-        flatten_data = torch.cat(
-            [data[key].contiguous().view(-1) for key in keys], dim=0).to(get_accelerator().device_name())
+        flatten_data = [data[key].contiguous().view(-1) for key in keys]
+        if all(data[key].is_pinned() for key in keys):
+            # Keep pinned batches pinned so the copy is asynchronous.
+            pinned_data = torch.empty(total_numel, dtype=datatype, pin_memory=True)
+            flatten_data = torch.cat(flatten_data, dim=0, out=pinned_data).to(
+                get_accelerator().device_name(), non_blocking=True)
+        else:
+            flatten_data = torch.cat(flatten_data, dim=0).to(get_accelerator().device_name())
     else:
         flatten_data = torch.empty(total_numel,
                                    device=get_accelerator().current_device_name(),
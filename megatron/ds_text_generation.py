@@ -6,11 +6,13 @@ from datetime import datetime
 import math
 import sys
 import time
+import copy
 import json
-from functools import partial
+from functools import partial, lru_cache
 # The earliest we can measure the start time.
 _TRAIN_START_TIME = time.time()
 import torch
+from packaging import version
 from torch.nn.utils.rnn import pad_sequence
 from torch.types import Number
 from typing import Dict, List, Any
@@ -23,7 +25,7 @@ from megatron import (
     print_rank_0, 
     is_rank_0
 )
-from megatron.utils import _expand_mask, _make_causal_mask, LeftPaddingCollator
+from megatron.utils import _expand_mask, LeftPaddingCollator
 from megatron.core import mpu, tensor_parallel
 from megatron.model import Float16Module, GPTModel, GPTModelPipe
 from megatron.core.enums import ModelType
@@ -32,13 +34,11 @@ from megatron.model import DistributedDataParallel as LocalDDP
 from megatron.data.data_samplers import build_pretraining_data_loader
 from megatron.utils import unwrap_model, update_rotary_pos_emb, set_backend_seq_length
 from megatron.arguments import core_transformer_config_from_args
-from megatron.text_generation.sampling import sample
+from megatron.text_generation.sampling import fused_sample
 from megatron.checkpointing import load_checkpoint
 from megatron.core.parallel_state import (
-    get_tensor_model_parallel_rank,
     get_tensor_model_parallel_world_size,
     get_tensor_model_parallel_group,
-    get_tensor_model_parallel_src_rank,
 )
 
 import deepspeed
@@ -52,11 +52,13 @@ class InferenceParams:
     """Inference parameters that are passed to the main model in order
     to efficienly calculate and store the context during inference."""
 
-    def __init__(self, max_batch_size, max_sequence_len):
+    def __init__(self, max_batch_size, max_sequence_len, max_new_tokens=None):
         """Note that offsets are set to zero and we always set the
         flag to allocate memory. After the first call, make sure to
         set this flag to False."""
         self.max_sequence_len = max_sequence_len
+        self.max_new_tokens = max_new_tokens
+        self.kv_cache_len = None
         self.max_batch_size = max_batch_size
         self.sequence_len_offset = 0
         self.next_sequence_len = 0
@@ -65,6 +67,16 @@ class InferenceParams:
         self.first_forward = True
         self.key_value_memory_dict = {}
 
+    def get_kv_cache_len(self):
+        """Length of the key/value cache. Fixed when the first layer
+        allocates its cache during the prompt forward: the prompt plus
+        `max_new_tokens`, capped at `max_sequence_len`."""
+        if self.kv_cache_len is None:
+            self.kv_cache_len = self.max_sequence_len if self.max_new_tokens is None \
+                else min(self.next_sequence_len + self.max_new_tokens,
+                         self.max_sequence_len)
+        return self.kv_cache_len
+
     def swap_key_value_dict(self, batch_idx):
         "swap between batches"
         if len(self.key_value_memory_dict) == 0:
@@ -86,25 +98,42 @@ class InferenceParams:
         """Set the attention mask."""
         self.attn_mask = attn_mask
 
+# Output buffer for the logits gathered by tensor_parallel_sample.
+_LOGITS_GATHER_BUFFER = None
+
+def _get_logits_gather_buffer(logits, world_size):
+    """Return a [world_size, *logits.shape] buffer, reused across steps."""
+    global _LOGITS_GATHER_BUFFER
+    shape = (world_size,) + tuple(logits.shape)
+    if _LOGITS_GATHER_BUFFER is None \
+            or _LOGITS_GATHER_BUFFER.shape != shape \
+            or _LOGITS_GATHER_BUFFER.dtype != logits.dtype \
+            or _LOGITS_GATHER_BUFFER.device != logits.device:
+        _LOGITS_GATHER_BUFFER = torch.empty(shape, dtype=logits.dtype, device=logits.device)
+    return _LOGITS_GATHER_BUFFER
+
 def tensor_parallel_sample(logits, top_p=0.0, top_k=0, temperature=1.0):
+    """Gather the vocab parallel [b, v/p] logits and sample the next token.
+    Every tensor parallel rank samples from the same gathered logits with
+    the default generator, which is seeded identically within the tensor
+    parallel group, so all ranks pick the same token without a broadcast."""
 
     world_size = get_tensor_model_parallel_world_size()
-    rank = get_tensor_model_parallel_rank()
-    dst_rank = get_tensor_model_parallel_src_rank()
 
-    if rank == 0:
-        tensor_list = [torch.empty_like(logits) for _ in range(world_size)]
+    # [p, b, v/p] buffer, written directly by the all-gather.
+    gather_buffer = _get_logits_gather_buffer(logits, world_size)
+    if version.parse(torch.__version__) >= version.parse('1.13'):
+        torch.distributed.all_gather_into_tensor(
+            gather_buffer.view(-1), logits.contiguous().view(-1),
+            group=get_tensor_model_parallel_group())
     else:
-        tensor_list = []
-    torch.distributed.gather(logits, tensor_list, dst=dst_rank, group=get_tensor_model_parallel_group())
-    
-    if rank == 0:
-        logits = torch.cat(tensor_list, dim=-1).contiguous()
-        new_token = sample(logits, top_p=top_p, top_k=top_k, temperature=temperature)
-    else:
-        new_token = torch.empty_like(logits[..., 0])
+        torch.distributed._all_gather_base(
+            gather_buffer.view(-1), logits.contiguous().view(-1),
+            group=get_tensor_model_parallel_group())
 
-    return new_token
+    # [p, b, v/p] -> [b, v], only copies when b > 1.
+    logits = gather_buffer.movedim(0, -2).reshape(*logits.shape[:-1], -1)
+    return fused_sample(logits, top_p=top_p, top_k=top_k, temperature=temperature)
 
 def model_provider(pre_process=True, post_process=True):
     """Build the model."""
@@ -117,14 +146,15 @@ def model_provider(pre_process=True, post_process=True):
     config = core_transformer_config_from_args(args)
     with deepspeed.zero.Init(sequence_data_parallel_group=mpu.get_sequence_data_parallel_group(),
                              remote_device=None if args.remote_device == 'none' else args.remote_device,
-                             config_dict_or_path=args.deepspeed_config,
+                             config_dict_or_path=_get_ds_config(args.deepspeed_config),
                              enabled=args.zero_stage == 3,
                              mpu=mpu):
         
         if args.deepspeed and not args.no_pipeline_parallel:
             inference_params_cls = partial(InferenceParams, 
                                            max_batch_size=args.micro_batch_size,
-                                           max_sequence_len=args.seq_length)
+                                           max_sequence_len=args.seq_length,
+                                           max_new_tokens=args.max_new_tokens)
             
             sample_fn = partial(tensor_parallel_sample, 
                                 temperature=args.temperature, 
@@ -152,46 +182,66 @@ def model_provider(pre_process=True, post_process=True):
     see_memory_usage(f"After Building Model", force=True)
     return model
 
+@lru_cache(maxsize=None)
+def _load_ds_config(config_path):
+    """Read the DeepSpeed config on rank 0 and broadcast it, so the
+    shared filesystem is hit once per job instead of once per rank."""
+    ds_config_dict = [None]
+    if torch.distributed.get_rank() == 0:
+        with open(config_path, 'r', encoding='utf-8') as config_file:
+            ds_config_dict[0] = json.load(config_file)
+    torch.distributed.broadcast_object_list(ds_config_dict, src=0)
+    return ds_config_dict[0]
+
+def _get_ds_config(deepspeed_config):
+    if deepspeed_config is None or isinstance(deepspeed_config, dict):
+        return deepspeed_config
+    # Copy so callers cannot modify the cached config.
+    return copy.deepcopy(_load_ds_config(deepspeed_config))
+
 def _create_ds_config_dict():
     args = get_args()
-    if isinstance(args.deepspeed_config, dict) :
-        ds_config_dict = args.deepspeed_config
-    else:
-        with open(args.deepspeed_config, 'r', encoding='utf-8') as config_file:
-            ds_config_dict = json.load(config_file)
+    ds_config_dict = _get_ds_config(args.deepspeed_config)
 
     if args.universal_checkpoint:
         ds_config_dict["checkpoint"] = {"load_universal": True}
 
+    # Generation never steps an optimizer, keep DeepSpeed from allocating
+    # optimizer states and a scheduler when a training config is reused.
+    for key in ("optimizer", "scheduler"):
+        if ds_config_dict.pop(key, None) is not None:
+            print_rank_0(f"Ignoring the '{key}' section of the DeepSpeed config for generation.")
+
     # Clear config path
     args.deepspeed_config = None 
 
     return ds_config_dict
 
+@lru_cache(maxsize=8)
+def _get_position_ids(seq_length, device):
+    return torch.arange(seq_length, dtype=torch.long, device=device)
+
 def get_batch_pipe(data):
     """Modification of `get_batch` to work on `next(data_iterator)` instead of `data_iterator`"""
     args = get_args()
-    tokenizer = get_tokenizer()
 
     # Items and their type.
     keys = ['input_ids']
     datatype = torch.int64
     data_b = tensor_parallel.broadcast_data(keys, data, datatype)
-    tokens = data_b['input_ids'].long()
+    tokens = data_b['input_ids']
 
     keys = ['attention_mask']
     datatype = torch.bool
     data_b = tensor_parallel.broadcast_data(keys, data, datatype)
-    attention_mask = data_b['attention_mask'].bool()
+    attention_mask = data_b['attention_mask']
     
-    max_length = min(tokens.shape[-1] + args.max_new_tokens, args.seq_length)
-    combined_attention_mask = _make_causal_mask(tokens.shape, max_length=args.seq_length) \
-        .to(get_accelerator().current_device_name())
     # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
-    expanded_attn_mask = _expand_mask(attention_mask, max_length=args.seq_length).bool()
-    combined_attention_mask = expanded_attn_mask + combined_attention_mask
+    expanded_attn_mask = _expand_mask(attention_mask, max_length=args.seq_length)
+    # args.attn_mask is the causal mask cached on device by set_backend_seq_length.
+    combined_attention_mask = expanded_attn_mask | args.attn_mask
 
-    position_ids = torch.arange(tokens.shape[1], dtype=torch.long, device=get_accelerator().current_device_name())
+    position_ids = _get_position_ids(tokens.shape[1], get_accelerator().current_device_name())
     # suit for megatron pipe module format.
     return (tokens, position_ids, combined_attention_mask), ()
 
@@ -217,6 +267,7 @@ def setup_model(model_provider_func, model_type):
             assert model.grid.get_pipe_parallel_rank() == mpu.get_pipeline_model_parallel_rank()
             assert model.grid.get_slice_parallel_rank() == mpu.get_tensor_model_parallel_rank()
             assert model.grid.get_data_parallel_rank() == mpu.get_data_parallel_rank()
+        model.eval()
         model = [model]
 
     assert args.load
@@ -240,6 +291,16 @@ def setup_model(model_provider_func, model_type):
     if args.random_ltd:
         model[0] = convert_to_random_ltd(model[0], ParallelTransformerLayer)
 
+    # Decode steps repeat the same small shapes, let inductor fuse the
+    # per-layer elementwise ops. Shapes are dynamic so the growing key/value
+    # length does not trigger a recompilation every step.
+    if args.compile_transformer_layers:
+        assert version.parse(torch.__version__) >= version.parse('2.0'), \
+            '--compile-transformer-layers requires torch 2.0 or newer'
+        for module in model[0].modules():
+            if isinstance(module, ParallelTransformerLayer):
+                module.forward = torch.compile(module.forward, dynamic=True)
+
     return model
 
 def get_model(model_type=ModelType.encoder_or_decoder, wrap_with_ddp=True):
@@ -264,9 +325,12 @@ def get_model(model_type=ModelType.encoder_or_decoder, wrap_with_ddp=True):
     # Only parameters that are already tensor model parallel have these
     # attributes set for them. We should make sure the default attributes
     # are set for all params so the optimizer can use them.
+    # Count the parameters in the same pass.
+    num_parameters = 0
     for model_module in model:
         for param in model_module.parameters():
             tensor_parallel.set_defaults_if_not_set_tensor_model_parallel_attributes(param)
+            num_parameters += param.ds_numel if hasattr(param, 'ds_id') else param.nelement()
 
     # Print number of parameters.
     if mpu.get_data_parallel_rank() == 0:
@@ -274,26 +338,31 @@ def get_model(model_type=ModelType.encoder_or_decoder, wrap_with_ddp=True):
               'model parallel rank ({}, {}): {}'.format(
             mpu.get_tensor_model_parallel_rank(),
             mpu.get_pipeline_model_parallel_rank(),
-            sum([sum([p.ds_numel if hasattr(p,'ds_id') else p.nelement() for p in model_module.parameters()])
-                 for model_module in model])), flush=True)
+            num_parameters), flush=True)
 
     return model
 
 def main(args_defaults = None):
     initialize_megatron(args_defaults=args_defaults)
     args = get_args()
+    # Let any remaining fp32 matmuls use TF32 tensor cores.
+    torch.backends.cuda.matmul.allow_tf32 = True
     tokenizer = get_tokenizer()
     data = [{"text":"This can be achiefved by directly using the LlamaTokenizer class, or passing in"},
             {"text":"Of cause, I'm not a fan of the new movie. It's too bad that"},
             {"text":"Of cause, I'm not a fan of the new movie. It's too bad that"},
             {"text":"the angry owner doused Tuffy with boiling hot water and threw him off a"}
             ]
-    inputs_ids = list(map(lambda dict: {"input_ids": torch.tensor(tokenizer.tokenize(dict['text']))}, data))    
+    texts = [sample['text'] for sample in data]
+    inputs_ids = [{"input_ids": torch.as_tensor(ids, dtype=torch.long)}
+                  for ids in tokenizer.tokenize_batch(texts)]
     collator = LeftPaddingCollator(tokenizer.pad)
     data_loader = build_pretraining_data_loader(inputs_ids, args.consumed_train_samples, collate_fn=collator)
     data_iter = iter(data_loader)
     model = setup_model(model_provider_func=model_provider, model_type=ModelType.encoder_or_decoder)
-    result = model[0].generate_batch(data_iter, max_new_tokens=args.max_new_tokens)
+    # Generation never runs backward, skip autograd and version counter bookkeeping.
+    with torch.inference_mode():
+        result = model[0].generate_batch(data_iter, max_new_tokens=args.max_new_tokens)
     if dist.get_rank() == 0:
         print(result)
 
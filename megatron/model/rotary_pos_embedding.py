@@ -9,7 +9,7 @@ import torch
 
 from torch import einsum, nn
 
-__all__ = ['RotaryEmbedding', 'apply_rotary_pos_emb']
+__all__ = ['RotaryEmbedding', 'RotaryEmbeddingCache', 'apply_rotary_pos_emb']
 
 class RotaryEmbedding(nn.Module):
     def __init__(self, dim):
@@ -30,6 +30,28 @@ class RotaryEmbedding(nn.Module):
         return rearrange(emb, 'n d -> n 1 1 d')
 
 
+class RotaryEmbeddingCache:
+    """
+    Precomputed cos/sin tables of a rotary embedding.
+    Indexing slices both tables along the sequence dimension, so callers
+    can treat it like the frequency tensor returned by RotaryEmbedding.
+    """
+    def __init__(self, cos, sin):
+        self.cos = cos
+        self.sin = sin
+
+    @classmethod
+    def from_freqs(cls, freqs, dtype):
+        return cls(freqs.cos().to(dtype), freqs.sin().to(dtype))
+
+    @property
+    def shape(self):
+        return self.cos.shape
+
+    def __getitem__(self, idx):
+        return RotaryEmbeddingCache(self.cos[idx], self.sin[idx])
+
+
 def _rotate_half(x):
     """
     change sign so the last dimension becomes [-odd, +even]
@@ -44,13 +66,18 @@ def apply_rotary_pos_emb(t, freqs):
     """
     input tensor t is of shape [seq_length, ..., dim]
     rotary positional embeding tensor freqs is of shape [seq_length, ..., dim]
+    or a RotaryEmbeddingCache holding its precomputed cos/sin
     check https://kexue.fm/archives/8265 for detailed formulas
     """
-    rot_dim = freqs.shape[-1]
+    if isinstance(freqs, RotaryEmbeddingCache):
+        cos, sin = freqs.cos.to(t.dtype), freqs.sin.to(t.dtype)
+    else:
+        cos, sin = freqs.cos().to(t.dtype), freqs.sin().to(t.dtype)
+    rot_dim = cos.shape[-1]
     # ideally t_pass is empty so rotary pos embedding is applied to all tensor t
     t, t_pass = t[..., :rot_dim], t[..., rot_dim:]
 
     # first part is cosine component
     # second part is sine component, need to change signs with _rotate_half method
-    t = (t * freqs.cos().to(t.dtype)) + (_rotate_half(t) * freqs.sin().to(t.dtype))
+    t = (t * cos) + (_rotate_half(t) * sin)
     return t if t_pass.shape[-1] == 0 else torch.cat((t, t_pass), dim=-1)
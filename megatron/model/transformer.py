@@ -47,6 +47,12 @@ try:
 except ImportError:
     flash_attn_varlen_func = None
 
+try:
+    # FlashAttention-2 decoding against a key/value cache
+    from flash_attn import flash_attn_with_kvcache
+except ImportError:
+    flash_attn_with_kvcache = None
+
 FlashAttentionBuilder = get_accelerator().get_op_builder("FlashAttentionBuilder")
 flash_attn_builder = None
 
@@ -496,6 +502,10 @@ class ParallelAttention(MegatronModule):
             and attention_type == AttnType.self_attn \
             and self.attn_mask_type == AttnMaskType.causal
         self.use_flash_attn_triton = args.use_flash_attn_triton
+        # Single token decode steps read the key/value cache in place
+        self.use_flash_decoding = self.use_flash_attn and args.use_flash_attn_v2 \
+            and flash_attn_with_kvcache is not None \
+            and get_accelerator().device_name() == 'cuda'
         if self.use_flash_attn:
             global flash_attn_builder
             try:
@@ -653,10 +663,9 @@ class ParallelAttention(MegatronModule):
         # =================================================
         # Pre-allocate memory for key-values for inference.
         # =================================================
-        is_first_step = False
         if inference_params:
             if self.layer_number not in inference_params.key_value_memory_dict:
-                inf_max_seq_len = inference_params.max_sequence_len
+                inf_max_seq_len = inference_params.get_kv_cache_len()
                 inf_max_batch_size = inference_params.max_batch_size
                 inference_key_memory = self._allocate_memory(
                     inf_max_seq_len, inf_max_batch_size)
@@ -664,7 +673,6 @@ class ParallelAttention(MegatronModule):
                     inf_max_seq_len, inf_max_batch_size)
                 inference_params.key_value_memory_dict[self.layer_number] = (
                     inference_key_memory, inference_value_memory)
-                is_first_step = True
             else:
                 inference_key_memory, inference_value_memory = \
                     inference_params.key_value_memory_dict[self.layer_number]
@@ -735,6 +743,17 @@ class ParallelAttention(MegatronModule):
             sequence_start = inference_params.sequence_len_offset
             sequence_end = sequence_start + key_layer.size(0)
             assert sequence_end <= inference_key_memory.size(0)
+
+            # Rotate the new queries and keys at their positions before
+            # caching, so the cached keys are used as is on later steps.
+            if rotary_pos_emb is not None:
+                q_pos_emb, k_pos_emb = rotary_pos_emb
+                query_layer = apply_rotary_pos_emb(
+                    query_layer, q_pos_emb[sequence_start:sequence_end])
+                key_layer = apply_rotary_pos_emb(
+                    key_layer, k_pos_emb[sequence_start:sequence_end])
+                rotary_pos_emb = None
+
             # Copy key and values.
             inference_key_memory[sequence_start:sequence_end,
                                  batch_start:batch_end, ...] = key_layer
@@ -746,27 +765,6 @@ class ParallelAttention(MegatronModule):
                 :sequence_end, batch_start:batch_end, ...]
 
 
-            # adjust the key rotary positional embedding
-            if rotary_pos_emb is not None:
-                q_pos_emb, k_pos_emb = rotary_pos_emb
-                # need to cross check this condition during inference
-                # if not set_inference_key_value_memory:
-                if not is_first_step:
-                    # In inference, we compute one token at a time.
-                    # Select the correct positional embedding
-                    # (only the last token in the sequence)
-                    q_pos_emb = q_pos_emb[sequence_end - 1 : sequence_end]
-                else:
-                    # In the first forward pass of inference,
-                    # we use the entire provided prefix.
-                    # q_pos_emb here has the rope embeddings of the entire
-                    # prefix + to-be-generated output so
-                    # we slice to just the prefix.
-                    q_pos_emb = q_pos_emb[:sequence_end, :, :, :]
-                k_pos_emb = k_pos_emb[:sequence_end, :, :, :]
-                rotary_pos_emb = (q_pos_emb, k_pos_emb)
-
-
         # ==================================
         # core attention computation
         # ==================================
@@ -794,7 +792,17 @@ class ParallelAttention(MegatronModule):
             else:
                 context_layer = self.dist_attn(query_layer, key_layer, value_layer, attention_mask)
         else:
-            if self.use_flash_attn:
+            if self.use_flash_decoding and inference_params and query_layer.size(0) == 1:
+                # Single query token attends to the whole cache, no causal mask
+                # needed. [s, b, np, hn] -> [b, s, np, hn] views of the cache,
+                # which already holds rotated keys, so the kernel reads it in place.
+                query_layer, key_layer, value_layer = [rearrange(x, 's b ... -> b s ...')
+                        for x in (query_layer, key_layer, value_layer)]
+
+                context_layer = flash_attn_with_kvcache(query_layer, key_layer, value_layer)
+
+                context_layer = rearrange(context_layer, 'b s h d -> s b (h d)').contiguous()
+            elif self.use_flash_attn:
                 if not self.use_flash_attn_triton:
                     query_layer, key_layer, value_layer = [rearrange(x, 's b ... -> b s ...').contiguous()
                             for x in (query_layer, key_layer, value_layer)]
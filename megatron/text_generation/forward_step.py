@@ -41,6 +41,10 @@ class InferenceParams:
             self.key_value_memory_dict[layer_number] = (
                     new_inference_key_memory, new_inference_value_memory)
 
+    def get_kv_cache_len(self):
+        """Length of the key/value cache."""
+        return self.max_sequence_len
+
 class ForwardStep:
     """Forward step function with all the communications.
     We use a class here to hide the inference parameters
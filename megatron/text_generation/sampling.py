@@ -8,7 +8,16 @@ Part of this code is inspired by:
 
 
 import torch
+from packaging import version
 
+try:
+    import flashinfer
+    from flashinfer.sampling import top_k_top_p_sampling_from_logits
+    # Older releases take uniform samples and return (samples, success).
+    if version.parse(flashinfer.__version__) < version.parse('0.2.3'):
+        top_k_top_p_sampling_from_logits = None
+except ImportError:
+    top_k_top_p_sampling_from_logits = None
 
 
 def modify_logits_for_top_k_filtering(logits, top_k):
@@ -19,12 +28,15 @@ def modify_logits_for_top_k_filtering(logits, top_k):
 
 
 
-def modify_logits_for_top_p_filtering(logits, top_p):
-    """Set the logits for none top-p values to -inf."""
+def sorted_top_p_filter(logits, top_p):
+    """Sort the logits and compute the top-p filter in sorted order.
+    Returns the sorted probabilities, the sort indices and the filter,
+    where True marks the sorted entries outside the top-p set."""
 
     # First sort and calculate cumulative sum of probabilities.
     sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-    cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+    sorted_probs = sorted_logits.softmax(dim=-1)
+    cumulative_probs = sorted_probs.cumsum(dim=-1)
 
     # Filteration based on the cumulative sum.
     filter_ = cumulative_probs > top_p
@@ -36,12 +48,36 @@ def modify_logits_for_top_p_filtering(logits, top_p):
     # Make sure we at least have one token to select from.
     filter_[..., 0] = 0
 
+    return sorted_probs, sorted_indices, filter_
+
+
+
+def modify_logits_for_top_p_filtering(logits, top_p):
+    """Set the logits for none top-p values to -inf."""
+
+    _, sorted_indices, filter_ = sorted_top_p_filter(logits, top_p)
+
     # Fill in the filtered part
     filter_ = filter_.scatter(1, sorted_indices, filter_)
     logits.masked_fill_(filter_, float('-Inf'))
 
 
 
+def sample_with_top_p_filtering(logits, top_p):
+    """Sample from the top-p filtered distribution of the logits.
+    Same filtering as `modify_logits_for_top_p_filtering`, but the sorted
+    probabilities are sampled directly instead of scattering the filter
+    back, masking the logits and computing a second softmax."""
+
+    sorted_probs, sorted_indices, filter_ = sorted_top_p_filter(logits, top_p)
+
+    # multinomial does not need the remaining probabilities renormalized.
+    sorted_probs.masked_fill_(filter_, 0.0)
+    sorted_samples = torch.multinomial(sorted_probs, num_samples=1)
+    return sorted_indices.gather(1, sorted_samples).view(-1)
+
+
+
 def sample(logits, top_k=0, top_p=0.0, temperature=1.0, vocab_size=None):
     """ Sample and generate a token.
     Note: logits has the dimension [b, v] where b is the batch size
@@ -77,13 +113,55 @@ def sample(logits, top_k=0, top_p=0.0, temperature=1.0, vocab_size=None):
                 assert top_k < vocab_size, 'top-k is larger than vocab size.'
             modify_logits_for_top_k_filtering(logits, top_k)
 
-        elif top_p > 0.0:
+        if top_p > 0.0:
             assert top_p <= 1.0, 'top-p should be in (0, 1].'
-            modify_logits_for_top_p_filtering(logits, top_p)
+            samples = sample_with_top_p_filtering(logits, top_p)
+        else:
+            # After filtering, we need to recalculate the distribution.
+            probs = logits.softmax(dim=-1)
+            samples = torch.multinomial(probs, num_samples=1).view(-1)
+
+    # If vocab size is provided, make sure the samples are in
+    # in the range [0, vocab-size).
+    if vocab_size:
+        samples = torch.clamp(samples, min=0, max=(vocab_size - 1))
+
+    return samples
+
+
 
-        # After filtering, we need to recalculate the distribution.
-        probs = logits.softmax(dim=-1)
-        samples = torch.multinomial(probs, num_samples=1).view(-1)
+def fused_sample(logits, top_k=0, top_p=0.0, temperature=1.0, vocab_size=None):
+    """ Same as `sample` but uses the fused FlashInfer top-k/top-p kernel.
+    Filtering, renormalization and the categorical draw are done in a
+    single pass over the [b, v] logits instead of the sort/topk/softmax
+    sequence of `sample`. Falls back to `sample` when FlashInfer (>= 0.2.3)
+    is not installed or for greedy decoding.
+    """
+
+    if top_k_top_p_sampling_from_logits is None or top_k == 1:
+        return sample(logits, top_k=top_k, top_p=top_p,
+                      temperature=temperature, vocab_size=vocab_size)
+
+    # Check logits for consistency.
+    assert logits.ndim == 2, 'expected the logits to be of [b, v] shape.'
+    assert logits.type() == 'torch.cuda.FloatTensor', \
+        'input logits should be floats.'
+    if top_k > 1:
+        assert top_p == 0.0, 'cannot set both top-k and top-p samplings.'
+        assert top_k <= logits.size(1), 'top-k is larger than logit size.'
+        if vocab_size:
+            assert top_k < vocab_size, 'top-k is larger than vocab size.'
+    elif top_p > 0.0:
+        assert top_p <= 1.0, 'top-p should be in (0, 1].'
+
+    if temperature != 1.0:
+        logits = logits / temperature
+
+    # The kernel always applies both filters, disable the unused one.
+    samples = top_k_top_p_sampling_from_logits(
+        logits,
+        top_k=top_k if top_k > 1 else logits.size(1),
+        top_p=top_p if top_p > 0.0 else 1.0).long()
 
     # If vocab size is provided, make sure the samples are in
     # in the range [0, vocab-size).
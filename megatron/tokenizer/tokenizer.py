@@ -96,6 +96,10 @@ class AbstractTokenizer(ABC):
     def tokenize(self, text):
         pass
 
+    def tokenize_batch(self, texts):
+        """Tokenize a list of texts, returns a list of token id lists."""
+        return [self.tokenize(text) for text in texts]
+
     def detokenize(self, token_ids):
         raise NotImplementedError('detokenizer is not implemented for {} '
                                   'tokenizer'.format(self.name))
@@ -10,7 +10,7 @@ from torch.nn.parallel import DistributedDataParallel as torchDDP
 from torch.nn.utils.rnn import pad_sequence
 from torch.types import Number
 from typing import Dict, List, Any
-from functools import partial
+from functools import partial, lru_cache
 
 from deepspeed.accelerator import get_accelerator
 if get_accelerator().device_name() == 'cuda':
@@ -25,7 +25,7 @@ from megatron import (
 from megatron.core import mpu, tensor_parallel
 from megatron.core.tensor_parallel import param_is_not_tensor_parallel_duplicate
 from megatron.model.module import param_is_not_shared
-from megatron.model.rotary_pos_embedding import RotaryEmbedding
+from megatron.model.rotary_pos_embedding import RotaryEmbedding, RotaryEmbeddingCache
 from megatron import get_tokenizer
 
 def update_rotary_pos_emb(seq_length):
@@ -41,7 +41,14 @@ def update_rotary_pos_emb(seq_length):
     # https://github.com/kingoflolz/mesh-transformer-jax/
     rotary_pos_emb = RotaryEmbedding(rotary_dim)(seq_length).to(
         get_accelerator().current_device_name())
-    args.rotary_pos_emb = rotary_pos_emb
+    # Cache cos/sin so layers and decode steps only slice them
+    args.rotary_pos_emb = RotaryEmbeddingCache.from_freqs(rotary_pos_emb, args.params_dtype)
+
+@lru_cache(maxsize=4)
+def _get_causal_attn_mask(seq_length, device):
+    """Boolean causal mask of shape [1, 1, s, s], True marks masked positions."""
+    return torch.triu(torch.ones((seq_length, seq_length), dtype=torch.bool, device=device),
+                      diagonal=1).view(1, 1, seq_length, seq_length)
 
 def set_backend_seq_length(seq_length):
     args = get_args()
@@ -50,19 +57,8 @@ def set_backend_seq_length(seq_length):
     # we can reuse it.
     if isinstance(seq_length, torch.Tensor):
         seq_length = int(seq_length)
-    attention_mask = torch.tril(torch.ones(
-        (1, seq_length, seq_length), device=get_accelerator().current_device_name())).view(
-            1, 1, seq_length, seq_length)
-
-    # Convert attention mask to binary:
-    attention_mask = (attention_mask < 0.5)
-    if args.fp16:
-        attention_mask = attention_mask.half()
-    elif args.bf16:
-        attention_mask = attention_mask.bfloat16()
-
-    # Convert to bool:
-    args.attn_mask = attention_mask.to(torch.bool)
+    args.attn_mask = _get_causal_attn_mask(
+        seq_length, get_accelerator().current_device_name())
 
     # For prertaining, since sequence length is fixed, cache rotary embedding in args, to avoid communicating around
     if args.use_rotary_position_embeddings:
@@ -287,11 +283,10 @@ def _make_causal_mask(input_ids_shape, max_length):
 
 def _expand_mask(mask, max_length=None):
     bsz, src_len = mask.size()
-    device = mask.device
     max_length = max_length if max_length is not None else src_len
 
-    mask = torch.concat((mask, torch.ones(bsz, max_length - src_len).bool().to(device)), 1)
-    expanded_mask = mask[:, None, None, :].expand(bsz, 1, max_length, max_length).bool()
+    mask = torch.concat((mask, mask.new_ones((bsz, max_length - src_len))), 1)
+    expanded_mask = mask[:, None, None, :].expand(bsz, 1, max_length, max_length)
     inverted_mask = ~expanded_mask
 
     return inverted_mask
@@ -464,23 +459,25 @@ def get_batch_pipe(data, mode = 'generate'):
     keys = ['input_ids']
     datatype = torch.int64
     data_b = tensor_parallel.broadcast_data(keys, data, datatype)
-    input_ids = data_b['input_ids'].long()
+    input_ids = data_b['input_ids']
 
     keys = ['attention_mask']
     datatype = torch.bool
     data_b = tensor_parallel.broadcast_data(keys, data, datatype)
-    attention_mask = data_b['attention_mask'].bool()
+    attention_mask = data_b['attention_mask']
 
+    # broadcast_data already returns tensors of the requested dtype, and the
+    # shifted tokens/labels are consumed as views.
     if mode == 'evaluation':
-        labels = input_ids[:, 1:].contiguous()
-        tokens = input_ids[:, :-1].contiguous()
+        labels = input_ids[:, 1:]
+        tokens = input_ids[:, :-1]
         attention_mask = attention_mask[:, :-1]
     elif mode == 'finetune':
         keys = ['labels']
         datatype = torch.int64
         data_b = tensor_parallel.broadcast_data(keys, data, datatype)
-        labels = data_b['labels'].long()[:, 1:].contiguous()
-        tokens = input_ids[:, :-1].contiguous()
+        labels = data_b['labels'][:, 1:]
+        tokens = input_ids[:, :-1]
         attention_mask = attention_mask[:, :-1]
     elif mode == 'generation':
         tokens = input_ids
@@ -490,7 +487,7 @@ def get_batch_pipe(data, mode = 'generate'):
     combined_attention_mask = _make_causal_mask(tokens.shape, max_length=args.seq_length) \
         .to(get_accelerator().current_device_name())
     # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
-    expanded_attn_mask = _expand_mask(attention_mask, max_length=args.seq_length).bool()
+    expanded_attn_mask = _expand_mask(attention_mask, max_length=args.seq_length)
     combined_attention_mask = expanded_attn_mask + combined_attention_mask
 
     position_ids = torch.arange(tokens.shape[1], dtype=torch.long, device=get_accelerator().current_device_name())
@@ -18,4 +18,17 @@ def test_broadcast_data():
     actual_output = broadcast_data([0,1],input_data, dtype)
     assert(torch.equal(actual_output[0], input_data[0]))
     assert(torch.equal(actual_output[1], input_data[1]))
-    Utils.destroy_model_parallel()
\ No newline at end of file
+    Utils.destroy_model_parallel()
+
+def test_broadcast_data_pinned():
+    Utils.initialize_model_parallel(2,4)
+    input_data = {
+        0 : (torch.ones((8,8)) * 0.0).pin_memory(),
+        1 : (torch.ones((8,8)) * 1.0).pin_memory()
+        }
+    dtype = torch.float32
+    actual_output = broadcast_data([0,1],input_data, dtype)
+    assert(actual_output[0].is_cuda)
+    assert(torch.equal(actual_output[0].cpu(), input_data[0]))
+    assert(torch.equal(actual_output[1].cpu(), input_data[1]))
+    Utils.destroy_model_parallel()